@@ -11,14 +11,19 @@ License: MIT
 """
 
 import os
-import hashlib
+import argparse
 import re
 from datetime import datetime
-import time
-import requests
+import httpx
+import xxhash
 import json
+import sqlite3
 import asyncio
+import threading
+import aiofiles
+from aiolimiter import AsyncLimiter
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 import logging
@@ -34,6 +39,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Characters that are not allowed in file names
+_FILENAME_RE = re.compile(r'[\\/*?:"<>|]')
+
+# Bytes sampled from the start and end of a file to spot reposts before a full download
+HEAD_SAMPLE_SIZE = 64 * 1024
+
+# Google Docs rejects batchUpdate calls with more requests than this
+DOCS_BATCH_LIMIT = 500
+# Number of queued transcriptions that triggers an early Docs flush
+DOCS_FLUSH_EVERY = 50
+
+
+class TranscriptFailedError(Exception):
+    """AssemblyAI reported that a transcription job failed."""
+
+
 class AudioTranscriber:
     def __init__(self, config_file='config.json'):
         """Initialize the AudioTranscriber with configuration."""
@@ -41,11 +62,37 @@ class AudioTranscriber:
         self.client = None
         self.docs_service = None
         self.drive_service = None
+        self._docs_requests = {}
+        self._doc_id_cache = {}
+        # Checkpoint keys whose inserts reached Google Docs but are not marked yet
+        self._docs_sent_keys = []
+        # Flushes run on executor threads; the lock keeps them from overlapping
+        self._docs_lock = threading.Lock()
         
         # Create directories
         os.makedirs(self.config['download_dir'], exist_ok=True)
         os.makedirs(self.config['transcription_dir'], exist_ok=True)
         
+        # Fingerprints of already-processed files, kept across runs
+        self._fp_db = sqlite3.connect(self.config.get('fingerprint_db', 'fingerprints.db'))
+        self._fp_pending = 0
+        self.setup_fingerprint_db()
+        
+        # One HTTP/2 client for all AssemblyAI calls so requests share connections
+        self.http = httpx.AsyncClient(
+            headers={"authorization": self.config['assemblyai']['api_key']},
+            timeout=httpx.Timeout(600.0, connect=10.0),
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+                retries=3  # connection failures only
+            )
+        )
+        
+        # AssemblyAI allows 20,000 requests per 5 minutes; stay safely below it
+        self._aai_limiter = AsyncLimiter(self.config['assemblyai'].get('requests_per_second', 60), 1)
+        self.limiter_waited_total = 0.0
+        
     def load_config(self, config_file):
         """Load configuration from JSON file."""
         try:
@@ -58,25 +105,112 @@ class AudioTranscriber:
             logger.error(f"Invalid JSON in {config_file}")
             raise
     
-    def calculate_md5(self, file_path):
-        """Calculate MD5 hash of a file to detect duplicates."""
-        # Using MD5 for file deduplication only, not for security purposes
-        hash_md5 = hashlib.md5(usedforsecurity=False)  # nosec B324
-        try:
-            with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            return hash_md5.hexdigest()
-        except Exception as e:
-            logger.error(f"Error calculating MD5 for {file_path}: {e}")
-            return None
-    
     def clean_filename(self, filename):
         """Clean filename by removing invalid characters."""
-        return re.sub(r'[\\/*?:"<>|]', "_", filename)
+        return _FILENAME_RE.sub("_", filename)
+    
+    def setup_fingerprint_db(self):
+        """Create the fingerprint and checkpoint tables if they do not exist yet."""
+        self._fp_db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints "
+            "(message_key TEXT PRIMARY KEY, size INTEGER, mtime REAL, fp TEXT)"
+        )
+        self._fp_db.execute(
+            "CREATE TABLE IF NOT EXISTS server_ids "
+            "(file_id INTEGER, access_hash INTEGER, PRIMARY KEY (file_id, access_hash))"
+        )
+        self._fp_db.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints "
+            "(message_key TEXT PRIMARY KEY, status TEXT, file_path TEXT, filename TEXT, "
+            "size INTEGER, mtime REAL, file_id INTEGER, access_hash INTEGER, fp TEXT, "
+            "transcript_id TEXT, docs_flushed INTEGER DEFAULT 0)"
+        )
+        self._fp_db.commit()
+    
+    def rebuild_index(self):
+        """Forget stored fingerprints and checkpoints so all files are processed again."""
+        self._fp_db.execute("DROP TABLE IF EXISTS fingerprints")
+        self._fp_db.execute("DROP TABLE IF EXISTS server_ids")
+        self._fp_db.execute("DROP TABLE IF EXISTS checkpoints")
+        self._fp_db.commit()
+        self.setup_fingerprint_db()
+        logger.info("Fingerprint index cleared")
+    
+    def load_fingerprints(self):
+        """Return the fingerprints of every file completed by previous runs."""
+        return {row[0] for row in self._fp_db.execute("SELECT fp FROM fingerprints")}
+    
+    def store_fingerprint(self, message_key, size, mtime, fingerprint):
+        """Record the fingerprint of a fully processed message, committing in batches."""
+        self._fp_db.execute(
+            "INSERT OR REPLACE INTO fingerprints (message_key, size, mtime, fp) VALUES (?, ?, ?, ?)",
+            (message_key, size, mtime, fingerprint)
+        )
+        self._fp_pending += 1
+        if self._fp_pending >= 50:
+            self.commit_fingerprints()
+    
+    def load_server_ids(self):
+        """Return the Telegram (file id, access hash) pairs seen by previous runs."""
+        return set(self._fp_db.execute("SELECT file_id, access_hash FROM server_ids"))
+    
+    def store_server_id(self, file_id, access_hash):
+        """Record a Telegram file as seen, committing in batches."""
+        self._fp_db.execute(
+            "INSERT OR IGNORE INTO server_ids (file_id, access_hash) VALUES (?, ?)",
+            (file_id, access_hash)
+        )
+        self._fp_pending += 1
+        if self._fp_pending >= 50:
+            self.commit_fingerprints()
+    
+    def get_checkpoint(self, key):
+        """Return the saved progress of a message, or None if it was never started."""
+        row = self._fp_db.execute(
+            "SELECT status, file_path, filename, size, mtime, file_id, access_hash, fp, "
+            "transcript_id, docs_flushed FROM checkpoints WHERE message_key = ?",
+            (key,)
+        ).fetchone()
+        if not row:
+            return None
+        columns = (
+            'status', 'file_path', 'filename', 'size', 'mtime', 'file_id', 'access_hash', 'fp',
+            'transcript_id', 'docs_flushed'
+        )
+        return dict(zip(columns, row))
+    
+    def save_checkpoint(self, key, **fields):
+        """Update the saved progress of a message and commit it immediately."""
+        self._fp_db.execute("INSERT OR IGNORE INTO checkpoints (message_key) VALUES (?)", (key,))
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        self._fp_db.execute(
+            f"UPDATE checkpoints SET {assignments} WHERE message_key = ?",  # nosec B608
+            (*fields.values(), key)
+        )
+        self._fp_db.commit()
+    
+    def complete_message(self, key):
+        """Mark a message as fully processed and remember its file for later runs."""
+        self.save_checkpoint(key, docs_flushed=1)
+        checkpoint = self.get_checkpoint(key)
+        self.store_fingerprint(key, checkpoint['size'], checkpoint['mtime'], checkpoint['fp'])
+        self.store_server_id(checkpoint['file_id'], checkpoint['access_hash'])
+    
+    def commit_fingerprints(self):
+        """Flush pending fingerprint writes to disk."""
+        self._fp_db.commit()
+        self._fp_pending = 0
     
     async def setup_telegram_client(self):
         """Setup and authenticate Telegram client."""
+        try:
+            import cryptg  # noqa: F401
+        except ImportError:
+            logger.warning(
+                "cryptg is not installed, Telegram downloads will use slow pure-Python decryption. "
+                "Install it with: pip install cryptg"
+            )
+        
         try:
             self.client = TelegramClient(
                 'session_name',
@@ -107,17 +241,122 @@ class AudioTranscriber:
             logger.error(f"Failed to setup Google services: {e}")
             raise
     
-    def transcribe_audio(self, file_path):
-        """Transcribe audio file using AssemblyAI."""
+    async def _read_chunks(self, file_path, chunk_size=1 << 20):
+        """Yield a file's contents in fixed-size chunks without blocking the event loop."""
+        async with aiofiles.open(file_path, "rb") as f:
+            # Audio is read once front to back, so ask for readahead and keep it
+            # out of the page cache afterwards
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            try:
+                while True:
+                    chunk = await f.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    
+    async def _aai_request(self, method, url, upload_path=None, stream=False, max_attempts=5, **kwargs):
+        """
+        Send a rate-limited AssemblyAI request.
+        
+        When upload_path is given, the file is streamed as the request body. With
+        stream=True the response body is left unread for the caller.
+        """
+        loop = asyncio.get_running_loop()
+        delay = 1.0
+        
+        for attempt in range(1, max_attempts + 1):
+            if upload_path:
+                # A streamed body keeps memory flat for large files
+                kwargs['content'] = self._read_chunks(upload_path)
+            
+            started = loop.time()
+            async with self._aai_limiter:
+                self.limiter_waited_total += loop.time() - started
+                request = self.http.build_request(method, url, **kwargs)
+                response = await self.http.send(request, stream=stream)
+            
+            # Only idempotent requests are retried on server errors
+            retryable = response.status_code == 429 or (
+                method == 'GET' and response.status_code in (500, 502, 503, 504)
+            )
+            if not retryable or attempt == max_attempts:
+                return response
+            await response.aclose()
+            
+            try:
+                retry_after = float(response.headers.get('Retry-After', delay))
+            except ValueError:
+                retry_after = delay
+            logger.warning(f"AssemblyAI returned {response.status_code}, retrying in {retry_after}s")
+            await asyncio.sleep(retry_after)
+            delay = min(delay * 2, 30.0)
+    
+    async def _read_json(self, response):
+        """Read a streamed JSON response into a buffer sized from its Content-Length."""
+        try:
+            length = int(response.headers.get('Content-Length', 0))
+            if length and 'Content-Encoding' not in response.headers:
+                # Filling a preallocated buffer avoids regrowing it for large transcripts
+                body = bytearray(length)
+                view = memoryview(body)
+                position = 0
+                async for chunk in response.aiter_raw():
+                    view[position:position + len(chunk)] = chunk
+                    position += len(chunk)
+            else:
+                # Compressed bodies (the usual case) have no decoded length to size against
+                body = await response.aread()
+        finally:
+            await response.aclose()
+        return json.loads(body)
+    
+    async def _poll_transcript(self, transcript_id):
+        """Poll AssemblyAI until a transcript is done, backing off between polls."""
+        polling_endpoint = f"https://api.assemblyai.com/v2/transcript/{transcript_id}"
+        delay = 1.0
+        
+        while True:
+            response = await self._aai_request('GET', polling_endpoint, stream=True, timeout=30)
+            if response.status_code >= 400:
+                await response.aread()
+                await response.aclose()
+                if response.status_code != 429 and response.status_code < 500:
+                    # AssemblyAI does not know this id (or rejects it), so polling again cannot help
+                    raise TranscriptFailedError(f"{response.status_code} {response.text}")
+                response.raise_for_status()
+            result = await self._read_json(response)
+            status = result["status"]
+            
+            if status == "completed":
+                return result["text"]
+            elif status == "error":
+                raise TranscriptFailedError(result.get("error", result))
+            
+            logger.info("Transcription in progress...")
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.7, 30.0)
+    
+    async def transcribe_audio(self, file_path, transcript_id=None, checkpoint_key=None):
+        """
+        Transcribe audio file using AssemblyAI.
+        
+        A transcript_id from an earlier run is polled instead of uploading the file again.
+        """
+        if transcript_id:
+            logger.info(f"Resuming transcription of {file_path}")
+            return await self._finish_transcription(file_path, transcript_id, checkpoint_key)
+        
         logger.info(f"Starting transcription of {file_path}")
         
         try:
             # Step 1: Upload audio file
             upload_endpoint = "https://api.assemblyai.com/v2/upload"
-            headers = {"authorization": self.config['assemblyai']['api_key']}
             
-            with open(file_path, "rb") as f:
-                response = requests.post(upload_endpoint, headers=headers, data=f, timeout=300)
+            response = await self._aai_request('POST', upload_endpoint, upload_path=file_path)
             
             if response.status_code != 200:
                 logger.error(f"Upload failed: {response.text}")
@@ -132,80 +371,437 @@ class AudioTranscriber:
                 "language_code": self.config['assemblyai'].get('language_code', 'fr')
             }
             
-            response = requests.post(transcript_endpoint, json=json_data, headers=headers, timeout=60)
+            response = await self._aai_request('POST', transcript_endpoint, json=json_data, timeout=60)
             
             if response.status_code != 200:
                 logger.error(f"Transcription submission failed: {response.text}")
                 return None
             
             transcript_id = response.json()["id"]
+            if checkpoint_key:
+                self.save_checkpoint(checkpoint_key, transcript_id=transcript_id)
             
-            # Step 3: Poll for completion
-            polling_endpoint = f"https://api.assemblyai.com/v2/transcript/{transcript_id}"
-            while True:
-                response = requests.get(polling_endpoint, headers=headers, timeout=30)
-                status = response.json()["status"]
-                
-                if status == "completed":
-                    logger.info(f"Transcription completed for {file_path}")
-                    return response.json()["text"]
-                elif status == "error":
-                    logger.error(f"Transcription error: {response.json()}")
-                    return None
-                
-                logger.info("Transcription in progress...")
-                time.sleep(5)
-                
         except Exception as e:
             logger.error(f"Error during transcription: {e}")
             return None
+        
+        # Step 3: Poll for completion
+        return await self._finish_transcription(file_path, transcript_id, checkpoint_key)
     
-    def upload_to_google_docs(self, channel_name, audio_name, transcription_text):
-        """Upload transcription to Google Docs."""
+    async def _finish_transcription(self, file_path, transcript_id, checkpoint_key=None):
+        """Wait for a submitted transcript and return its text."""
         try:
-            # Check if document already exists
-            query = f"name = '{channel_name} Transcriptions' and mimeType = 'application/vnd.google-apps.document'"
-            results = self.drive_service.files().list(q=query).execute()
-            items = results.get('files', [])
-            
-            if not items:
-                # Create new document
-                doc_metadata = {
-                    'name': f'{channel_name} Transcriptions',
-                    'mimeType': 'application/vnd.google-apps.document'
+            text = await self._poll_transcript(transcript_id)
+            logger.info(f"Transcription completed for {file_path}")
+            return text
+        except TranscriptFailedError as e:
+            logger.error(f"Transcription error: {e}")
+            if checkpoint_key:
+                # The job itself failed, so the next run has to upload the file again
+                self.save_checkpoint(checkpoint_key, transcript_id=None)
+            return None
+        except Exception as e:
+            # The job may still finish, so keep its id and just poll again next run
+            logger.error(f"Error during transcription: {e}")
+            return None
+    
+    def get_doc_id(self, channel_name):
+        """Find the channel's Google Doc, creating it if needed."""
+        if channel_name in self._doc_id_cache:
+            return self._doc_id_cache[channel_name]
+        
+        # Check if document already exists
+        query = f"name = '{channel_name} Transcriptions' and mimeType = 'application/vnd.google-apps.document'"
+        results = self.drive_service.files().list(q=query).execute()
+        items = results.get('files', [])
+        
+        if not items:
+            # Create new document
+            doc_metadata = {
+                'name': f'{channel_name} Transcriptions',
+                'mimeType': 'application/vnd.google-apps.document'
+            }
+            doc = self.drive_service.files().create(body=doc_metadata).execute()
+            doc_id = doc['id']
+            logger.info(f"New document created with ID: {doc_id}")
+        else:
+            doc_id = items[0]['id']
+            logger.info(f"Using existing document with ID: {doc_id}")
+        
+        self._doc_id_cache[channel_name] = doc_id
+        return doc_id
+    
+    def queue_upload(self, channel_name, audio_name, transcription_text, checkpoint_key=None):
+        """Queue a transcription for the next Google Docs flush."""
+        with self._docs_lock:
+            pending = self._docs_requests.setdefault(channel_name, [])
+            pending.append((checkpoint_key, {
+                'insertText': {
+                    'location': {'index': 1},
+                    'text': f"## {audio_name} ##\n\n{transcription_text}\n\n{'='*80}\n\n"
                 }
-                doc = self.drive_service.files().create(body=doc_metadata).execute()
-                doc_id = doc['id']
-                logger.info(f"New document created with ID: {doc_id}")
+            }))
+            return len(pending)
+    
+    def flush_docs(self):
+        """Upload all queued transcriptions to Google Docs."""
+        with self._docs_lock:
+            for channel_name, pending in self._docs_requests.items():
+                if not pending:
+                    continue
+                
+                try:
+                    doc_id = self.get_doc_id(channel_name)
+                    count = len(pending)
+                    
+                    # Requests are applied in order, so the document ends up as if
+                    # each transcription had been inserted on its own
+                    while pending:
+                        batch = pending[:DOCS_BATCH_LIMIT]
+                        self.docs_service.documents().batchUpdate(
+                            documentId=doc_id, body={'requests': [request for _, request in batch]}
+                        ).execute()
+                        del pending[:len(batch)]
+                        self._docs_sent_keys.extend(key for key, _ in batch if key)
+                    
+                    logger.info(f"{count} transcriptions added to Google Doc")
+                    
+                except Exception as e:
+                    # Whatever was not sent stays queued for the next flush
+                    logger.error(f"Error uploading to Google Docs: {e}")
+    
+    def mark_docs_flushed(self):
+        """Checkpoint every message whose transcription has reached Google Docs."""
+        # Runs on the event loop thread, which owns the SQLite connection
+        with self._docs_lock:
+            keys, self._docs_sent_keys = self._docs_sent_keys, []
+        for key in keys:
+            self.complete_message(key)
+    
+    def _tail_offset(self, size):
+        """Return where the tail sample of a file starts, aligned for Telegram requests."""
+        # Up to two sample blocks, so the tail is never just a few stray bytes
+        return max(0, ((size - 1) // HEAD_SAMPLE_SIZE - 1) * HEAD_SAMPLE_SIZE)
+    
+    async def download_sample(self, file, offset=0, blocks=1):
+        """Download a few sample blocks of a Telegram file starting at offset."""
+        chunks = []
+        async for chunk in self.client.iter_download(
+            file,
+            offset=offset,
+            limit=blocks,
+            request_size=HEAD_SAMPLE_SIZE,
+            file_size=file.size
+        ):
+            chunks.append(chunk)
+        return b"".join(chunks)
+    
+    async def download_media_parallel(self, file, file_path, part_size_kb=512, parts_per_task=4, max_parallel=4):
+        """
+        Download a Telegram file by fetching several byte ranges concurrently.
+        
+        Returns the xxHash3-128 fingerprint of the file, computed while downloading.
+        """
+        request_size = part_size_kb * 1024
+        span = request_size * parts_per_task
+        # More than a handful of parallel streams per file tends to trigger FLOOD_WAIT
+        semaphore = asyncio.Semaphore(max_parallel)
+        hasher = xxhash.xxh3_128()
+        hashed = asyncio.Condition()
+        next_offset = 0
+        
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        
+        def write_at(data, offset):
+            if hasattr(os, 'pwrite'):
+                os.pwrite(fd, data, offset)
             else:
-                doc_id = items[0]['id']
-                logger.info(f"Using existing document with ID: {doc_id}")
-            
-            # Add content to document
-            requests_body = [
-                {
-                    'insertText': {
-                        'location': {'index': 1},
-                        'text': f"## {audio_name} ##\n\n{transcription_text}\n\n{'='*80}\n\n"
-                    }
-                }
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, data)
+        
+        async def fetch_range(offset):
+            nonlocal next_offset
+            async with semaphore:
+                chunks = []
+                async for chunk in self.client.iter_download(
+                    file,
+                    offset=offset,
+                    limit=parts_per_task,
+                    request_size=request_size,
+                    file_size=file.size
+                ):
+                    chunks.append(chunk)
+                data = b"".join(chunks)
+                write_at(data, offset)
+                
+                # Ranges must be hashed in file order; keeping the semaphore until
+                # then bounds how many finished ranges wait in memory
+                async with hashed:
+                    await hashed.wait_for(lambda: next_offset == offset)
+                    hasher.update(data)
+                    next_offset += span
+                    hashed.notify_all()
+        
+        tasks = []
+        try:
+            # Pre-allocate the (sparse) file so every range can be written in place
+            os.ftruncate(fd, file.size)
+            tasks = [
+                asyncio.create_task(fetch_range(offset))
+                for offset in range(0, file.size, span)
             ]
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the remaining ranges before their descriptor goes away
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            os.close(fd)
+            os.remove(file_path)
+            raise
+        os.close(fd)
+        return hasher.hexdigest()
+    
+    async def _with_backoff(self, func, description, max_attempts=5, base_delay=1.0):
+        """Await func(), backing off exponentially when Telegram rate limits us."""
+        delay = base_delay
+        for attempt in range(1, max_attempts + 1):
+            try:
+                return await func()
+            except FloodWaitError as e:
+                if attempt == max_attempts:
+                    raise
+                wait = max(e.seconds, delay)
+                logger.warning(f"Rate limited while {description}, retrying in {wait}s")
+                await asyncio.sleep(wait)
+                delay *= 2
+    
+    async def produce_messages(self, channel_entity, download_q, num_workers):
+        """Queue every audio message of the channel for download."""
+        file_counter = 1
+        
+        async for message in self.client.iter_messages(channel_entity):
+            # Only fall back to the document's MIME type when Telegram doesn't flag it as audio
+            document = message.document
+            file = message.audio or message.voice or (
+                document if (getattr(document, 'mime_type', None) or '').startswith('audio/') else None
+            )
+            if file is None:
+                continue
+            
+            await download_q.put((message, file, file_counter))
+            file_counter += 1
+        
+        for _ in range(num_workers):
+            await download_q.put(None)
+    
+    async def download_worker(self, channel_name, download_q, transcribe_q, file_hashes, server_ids, head_seen, reposts):
+        """Download queued audio files and forward unique ones for transcription."""
+        while True:
+            item = await download_q.get()
+            if item is None:
+                break
             
-            self.docs_service.documents().batchUpdate(
-                documentId=doc_id, body={'requests': requests_body}
-            ).execute()
+            message, file, _ = item
+            server_id = (file.id, file.access_hash)
+            checkpoint_key = f"{message.chat_id}:{message.id}"
+            checkpoint = self.get_checkpoint(checkpoint_key)
+            if checkpoint and (checkpoint['size'], checkpoint['mtime']) != (file.size, message.date.timestamp()):
+                # The message now carries a different file, so process it from scratch
+                logger.info(f"Message {message.id} changed since the last run, processing it again")
+                checkpoint = None
             
-            logger.info(f"Transcription added to Google Doc")
-            return doc_id
+            # Pick up messages that an earlier run left half-way through
+            if checkpoint:
+                if checkpoint['docs_flushed']:
+                    logger.info(f"Already processed, skipping {checkpoint['filename']}")
+                    server_ids.add(server_id)
+                    file_hashes.add(checkpoint['fp'])
+                    continue
+                if checkpoint['transcript_id'] or os.path.exists(checkpoint['file_path']):
+                    logger.info(f"Resuming {checkpoint['filename']} from checkpoint")
+                    server_ids.add(server_id)
+                    file_hashes.add(checkpoint['fp'])
+                    await transcribe_q.put((checkpoint_key, checkpoint['file_path'], checkpoint['filename']))
+                    continue
+            
+            # Reposts of the same upload keep Telegram's file id, so skip them before downloading
+            if server_id in server_ids:
+                logger.info(f"Message {message.id} reposts an already seen file, skipping")
+                continue
+            if server_id in reposts:
+                # Another worker is fetching this file; hold on to the repost in case that fails
+                reposts[server_id].append(item)
+                continue
+            
+            reposts[server_id] = [item]
+            while reposts[server_id]:
+                candidate = reposts[server_id].pop(0)
+                if await self.download_message(
+                    candidate, channel_name, transcribe_q, file_hashes, head_seen
+                ):
+                    server_ids.add(server_id)
+                    break
+            
+            for skipped, _, _ in reposts.pop(server_id):
+                logger.info(f"Message {skipped.id} reposts an already seen file, skipping")
+    
+    async def download_message(self, item, channel_name, transcribe_q, file_hashes, head_seen):
+        """
+        Download one audio message and hand it to the transcribe stage.
+        
+        Returns False if the download failed, so a repost of the same file can be tried instead.
+        """
+        message, file, file_counter = item
+        server_id = (file.id, file.access_hash)
+        checkpoint_key = f"{message.chat_id}:{message.id}"
+        
+        try:
+            # Generate filename
+            original_name = getattr(file, 'file_name', f"audio_{message.id}.mp3")
+            if not original_name:
+                original_name = f"audio_{message.id}.mp3"
             
+            original_name = self.clean_filename(original_name)
+            message_date = message.date.strftime("%Y%m%d")
+            new_filename = f"{channel_name}_{file_counter:03d}_{original_name}_{message_date}.mp3"
+            file_path = os.path.join(self.config['download_dir'], new_filename)
+            mtime = message.date.timestamp()
+            
+            # Podcast files often open with identical ID3 tags and cover art, so a file
+            # matching a known one in size and opening bytes is only a suspected repost
+            # until its closing bytes match too
+            head = await self._with_backoff(
+                lambda: self.download_sample(file),
+                f"sampling {new_filename}"
+            )
+            head_key = (file.size, xxhash.xxh3_128_hexdigest(head))
+            tail_offset = self._tail_offset(file.size)
+            if head_key in head_seen:
+                tail = await self._with_backoff(
+                    lambda: self.download_sample(file, tail_offset, blocks=2),
+                    f"sampling {new_filename}"
+                )
+                if xxhash.xxh3_128_hexdigest(tail) in head_seen[head_key]:
+                    logger.info(f"Duplicate detected from file samples, skipping {new_filename}")
+                    self.store_server_id(*server_id)
+                    return True
+            
+            # Download file
+            logger.info(f"Downloading {new_filename}")
+            fingerprint = await self._with_backoff(
+                lambda: self.download_media_parallel(file, file_path),
+                f"downloading {new_filename}"
+            )
+            async with aiofiles.open(file_path, "rb") as f:
+                await f.seek(tail_offset)
+                tail = await f.read()
+            head_seen.setdefault(head_key, set()).add(xxhash.xxh3_128_hexdigest(tail))
+            
+            # Check for duplicates
+            if fingerprint in file_hashes:
+                logger.info(f"Duplicate detected, removing {new_filename}")
+                os.remove(file_path)
+                self.store_server_id(*server_id)
+                return True
+            
+            file_hashes.add(fingerprint)
+            
+            self.save_checkpoint(
+                checkpoint_key,
+                status='downloaded',
+                file_path=file_path,
+                filename=new_filename,
+                size=file.size,
+                mtime=mtime,
+                file_id=file.id,
+                access_hash=file.access_hash,
+                fp=fingerprint,
+                transcript_id=None,
+                docs_flushed=0
+            )
+            await transcribe_q.put((checkpoint_key, file_path, new_filename))
+            return True
         except Exception as e:
-            logger.error(f"Error uploading to Google Docs: {e}")
-            return None
+            logger.error(f"Error downloading message {message.id}: {e}")
+            return False
+    
+    async def transcribe_worker(self, transcribe_q, docs_q):
+        """Transcribe downloaded files and forward the text to the docs stage."""
+        while True:
+            item = await transcribe_q.get()
+            if item is None:
+                break
+            
+            checkpoint_key, file_path, new_filename = item
+            transcription_path = os.path.join(
+                self.config['transcription_dir'],
+                f"{new_filename}.txt"
+            )
+            try:
+                checkpoint = self.get_checkpoint(checkpoint_key)
+                
+                if checkpoint['status'] != 'downloaded' and os.path.exists(transcription_path):
+                    # Transcribed by an earlier run, only the Docs upload is missing
+                    async with aiofiles.open(transcription_path, 'r', encoding='utf-8') as f:
+                        transcription = await f.read()
+                else:
+                    transcription = await self.transcribe_audio(
+                        file_path, checkpoint['transcript_id'], checkpoint_key
+                    )
+                    if transcription is None:
+                        continue
+                    
+                    if not transcription:
+                        # Nothing was said, so there is nothing to upload either
+                        self.save_checkpoint(checkpoint_key, status='transcribed')
+                        self.complete_message(checkpoint_key)
+                        continue
+                    
+                    # Save transcription locally
+                    async with aiofiles.open(transcription_path, 'w', encoding='utf-8') as f:
+                        await f.write(transcription)
+                    self.save_checkpoint(checkpoint_key, status='transcribed')
+                
+                await docs_q.put((checkpoint_key, new_filename, transcription))
+            except Exception as e:
+                logger.error(f"Error handling transcription of {new_filename}: {e}")
+    
+    async def docs_worker(self, channel_name, docs_q):
+        """Queue transcriptions for Google Docs, flushing them in batches."""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            item = await docs_q.get()
+            if item is None:
+                break
+            
+            checkpoint_key, new_filename, transcription = item
+            queued = self.queue_upload(channel_name, new_filename, transcription, checkpoint_key)
+            self.save_checkpoint(checkpoint_key, status='docs_queued')
+            
+            if queued >= DOCS_FLUSH_EVERY:
+                await loop.run_in_executor(None, self.flush_docs)
+                self.mark_docs_flushed()
     
     async def process_channel(self):
         """Main method to process the Telegram channel."""
-        file_hashes = {}
-        file_counter = 1
+        # Fingerprints of completed files catch reposts of anything already transcribed
+        file_hashes = self.load_fingerprints()
+        head_seen = {}
+        server_ids = self.load_server_ids()
+        # Messages waiting on another worker that is downloading the same Telegram file
+        reposts = {}
+        workers = []
+        
+        concurrency = self.config.get('concurrency', {})
+        num_downloaders = concurrency.get('download_workers', 4)
+        num_transcribers = concurrency.get('transcribe_workers', 8)
+        
+        # Bounded queues apply backpressure so downloads don't race far ahead of transcription
+        download_q = asyncio.Queue(maxsize=num_downloaders * 2)
+        transcribe_q = asyncio.Queue(maxsize=num_transcribers * 2)
+        docs_q = asyncio.Queue()
         
         try:
             # Get channel entity
@@ -214,61 +810,47 @@ class AudioTranscriber:
             
             logger.info(f"Processing channel: {channel_name}")
             
-            # Iterate through messages
-            async for message in self.client.iter_messages(channel_entity):
-                if message.audio or message.voice or message.document:
-                    file = message.audio or message.voice or message.document
-                    
-                    # Check if it's an audio file
-                    if hasattr(file, 'mime_type') and 'audio' in file.mime_type:
-                        # Generate filename
-                        original_name = getattr(file, 'file_name', f"audio_{message.id}.mp3")
-                        if not original_name:
-                            original_name = f"audio_{message.id}.mp3"
-                        
-                        original_name = self.clean_filename(original_name)
-                        message_date = message.date.strftime("%Y%m%d")
-                        new_filename = f"{channel_name}_{file_counter:03d}_{original_name}_{message_date}.mp3"
-                        file_path = os.path.join(self.config['download_dir'], new_filename)
-                        
-                        # Download file
-                        logger.info(f"Downloading {new_filename}")
-                        await self.client.download_media(message, file_path)
-                        
-                        # Check for duplicates
-                        file_md5 = self.calculate_md5(file_path)
-                        if file_md5 and file_md5 in file_hashes:
-                            logger.info(f"Duplicate detected, removing {new_filename}")
-                            os.remove(file_path)
-                            continue
-                        
-                        if file_md5:
-                            file_hashes[file_md5] = file_path
-                        
-                        # Transcribe audio
-                        transcription = self.transcribe_audio(file_path)
-                        if transcription:
-                            # Save transcription locally
-                            transcription_path = os.path.join(
-                                self.config['transcription_dir'],
-                                f"{new_filename}.txt"
-                            )
-                            with open(transcription_path, 'w', encoding='utf-8') as f:
-                                f.write(transcription)
-                            
-                            # Upload to Google Docs
-                            self.upload_to_google_docs(channel_name, new_filename, transcription)
-                        
-                        file_counter += 1
-                        
-                        # Optional: Add delay to avoid rate limiting
-                        await asyncio.sleep(1)
+            downloaders = [
+                asyncio.create_task(self.download_worker(
+                    channel_name, download_q, transcribe_q, file_hashes, server_ids, head_seen, reposts
+                ))
+                for _ in range(num_downloaders)
+            ]
+            transcribers = [
+                asyncio.create_task(self.transcribe_worker(transcribe_q, docs_q))
+                for _ in range(num_transcribers)
+            ]
+            docs_uploader = asyncio.create_task(self.docs_worker(channel_name, docs_q))
+            producer = asyncio.create_task(
+                self.produce_messages(channel_entity, download_q, num_downloaders)
+            )
+            workers = [producer] + downloaders + transcribers + [docs_uploader]
+            
+            # Drain each stage in turn, sending one sentinel per worker downstream.
+            # The producer is awaited together with the downloaders so that a crashed
+            # downloader raises here instead of leaving the producer stuck on a full queue
+            await asyncio.gather(producer, *downloaders)
+            for _ in range(num_transcribers):
+                await transcribe_q.put(None)
+            await asyncio.gather(*transcribers)
+            await docs_q.put(None)
+            await docs_uploader
             
             logger.info("Processing completed successfully")
+            logger.info(f"limiter.waited_total={self.limiter_waited_total:.1f}s")
             
         except Exception as e:
             logger.error(f"Error processing channel: {e}")
             raise
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            # Cancelling the docs worker does not stop a flush already running in
+            # the executor; the lock makes this final flush wait for it
+            self.flush_docs()
+            self.mark_docs_flushed()
+            self.commit_fingerprints()
     
     async def run(self):
         """Run the complete transcription process."""
@@ -279,11 +861,23 @@ class AudioTranscriber:
         finally:
             if self.client:
                 await self.client.disconnect()
+            await self.http.aclose()
+            self._fp_db.close()
 
 
 async def main():
     """Main entry point."""
+    parser = argparse.ArgumentParser(description="Transcribe audio files from a Telegram channel")
+    parser.add_argument(
+        '--rebuild-index',
+        action='store_true',
+        help="forget stored fingerprints and process every file again"
+    )
+    args = parser.parse_args()
+    
     transcriber = AudioTranscriber()
+    if args.rebuild_index:
+        transcriber.rebuild_index()
     await transcriber.run()
 
 